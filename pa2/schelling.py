@@ -27,9 +27,109 @@ CS121: Schelling Model of Housing Segregation
   a single line in the linux command-line
 """
 
+import math
+
 import click
+import numpy as np
 import utility
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(**_options):
+        '''
+        Stand-in for numba.njit when numba is not installed: the kernels
+        below run as plain Python, just more slowly.
+        '''
+        return lambda func: func
+
+# Integer codes for the homes in a grid array
+FOR_SALE = 0
+MAROON = 1
+BLUE = 2
+COLORS = ("F", "M", "B")
+CODES = {"F": FOR_SALE, "M": MAROON, "B": BLUE}
+
+# Number of homes along a row that share one unsatisfied count: one
+# 64-byte cache line of the grid
+BLOCK = 64
+
+
+def to_array(grid):
+    '''
+    Convert a grid of strings into a uint8 array of color codes. Arrays
+    are returned unchanged.
+
+    Inputs:
+        grid: the grid (list of lists of strings or np.ndarray)
+
+    Returns: (np.ndarray of np.uint8) the grid as color codes
+    '''
+
+    if isinstance(grid, np.ndarray):
+        return grid
+
+    return np.array([[CODES[home] for home in row] for row in grid],
+                    dtype=np.uint8)
+
+
+def copy_to_grid(g, grid):
+    '''
+    Write the colors in a grid array back into a grid of strings.
+
+    Inputs:
+        g (np.ndarray): the grid as color codes
+        grid (list of lists of strings): the grid to update in place
+    '''
+
+    for row, codes in zip(grid, g.tolist()):
+        row[:] = [COLORS[code] for code in codes]
+
+
+@njit(cache=True, boundscheck=False)
+def _is_satisfied(g, R, x, y, color, lb, ub):
+    '''
+    Compiled neighborhood scan for is_satisfied.
+
+    Inputs:
+        g (np.ndarray): the grid as color codes
+        R (int): neighborhood parameter
+        x, y (int): an occupied grid location
+        color (int): color code of the homeowner at (x, y)
+        lb, ub (float): lower bound and upper bound on the similarity score
+
+    Returns: bool
+    '''
+
+    N = g.shape[0]
+    S = 0
+    H = 0
+    # number of diamond cells in the rows not scanned yet
+    remaining = 2*R*(R+1) + 1
+
+    for i in range(max(0, x-R), min(N, x+R+1)):
+        # |i-x| + |j-y| <= R gives the columns of the diamond in row i
+        w = R - abs(x-i)
+        for j in range(max(0, y-w), min(N, y+w+1)):
+            if g[i, j] == color:
+                S += 1
+                H += 1
+            elif g[i, j] != FOR_SALE:
+                H += 1
+        remaining -= 2*w + 1
+
+        # Stop once no choice of colors for the remaining cells can bring
+        # the score back into range.
+        if remaining > 0:
+            if (S + remaining)/(H + remaining) < lb:
+                return False
+            if S/(H + remaining) > ub:
+                return False
+
+    score = S/H
+
+    return lb <= score <= ub
+
 
 def is_satisfied(grid, R, location, sim_sat_range):
     '''
@@ -38,7 +138,7 @@ def is_satisfied(grid, R, location, sim_sat_range):
     and checking whether it falls within their satisfaction range (inclusive).
 
     Inputs:
-        grid: the grid
+        grid: the grid (list of lists of strings or np.ndarray)
         R (int): neighborhood parameter
         location (int, int): a grid location
         sim_sat_range (float, float): lower bound and upper bound on
@@ -49,133 +149,448 @@ def is_satisfied(grid, R, location, sim_sat_range):
     '''
     
     x,y = location
-    assert grid[x][y] != "F"
     lb,ub = sim_sat_range
+
+    if isinstance(grid, np.ndarray):
+        color = grid[x, y]
+        assert color != FOR_SALE
+        return _is_satisfied(grid, R, x, y, color, lb, ub)
+
+    # Scan the diamond of a list grid in place: converting the whole grid
+    # to an array would cost far more than the query itself.
+    color = grid[x][y]
+    assert color != "F"
+    N = len(grid)
     S = 0
     H = 0
 
-    for i in range(x-R, x+1+R):
-        for j in range(y-R, y+1+R):
-            if  i >= 0 and i < len(grid) and j >= 0 and j < len(grid):
-                distance = abs(x-i) + abs(y-j)
-                if distance <= R:
-                    if grid[i][j] == grid[x][y]:
-                        S += 1
-                        H += 1
-                    elif grid[i][j] != "F":
-                        H += 1
-    
-    score = S/H 
+    for i in range(max(0, x-R), min(N, x+R+1)):
+        w = R - abs(x-i)
+        row = grid[i]
+        for j in range(max(0, y-w), min(N, y+w+1)):
+            if row[j] == color:
+                S += 1
+                H += 1
+            elif row[j] != "F":
+                H += 1
+
+    score = S/H
 
     return lb <= score <= ub
        
 
+def _satisfaction_bounds(R, N, sim_sat_range):
+    '''
+    For every possible number H of occupied homes in a neighborhood, find
+    the numbers S of similar homes that give a satisfactory similarity
+    score, so that the kernels can compare integers instead of dividing.
+
+    Inputs:
+        R (int): neighborhood parameter
+        N (int): size of the grid
+        sim_sat_range (float, float): lower bound and upper bound on
+          the range (inclusive) for when the homeowner is satisfied
+          with his similarity score
+
+    Returns: (np.ndarray) array where the homeowner is satisfied exactly
+      when bounds[H, 0] <= S <= bounds[H, 1]
+    '''
+
+    lb,ub = sim_sat_range
+    max_homes = min(2*R*(R+1) + 1, N*N)
+    bounds = np.zeros((max_homes + 1, 2), dtype=np.int64)
+    bounds[0] = (1, 0)
+
+    for H in range(1, max_homes + 1):
+        # S/H is monotone in S, so the satisfactory S form a range. Start
+        # just outside it and step in, using the same S/H as is_satisfied.
+        low = max(0, math.floor(lb*H) - 1)
+        while low <= H and low/H < lb:
+            low += 1
+        high = min(H, math.ceil(ub*H) + 1)
+        while high >= 0 and high/H > ub:
+            high -= 1
+        bounds[H] = (low, high)
+
+    return bounds
+
+
+@njit(cache=True, boundscheck=False)
+def _satisfied(counts, bounds, x, y, color):
+    '''
+    Determine whether a homeowner is satisfied from the neighbor counts.
+
+    Inputs:
+        counts (np.ndarray): neighbor counts for the grid
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
+        x, y (int): the homeowner's location
+        color (int): color code of the homeowner
+
+    Returns: bool
+    '''
+
+    S = counts[color-1, x, y]
+    H = counts[0, x, y] + counts[1, x, y]
+
+    return bounds[H, 0] <= S <= bounds[H, 1]
+
+
+@njit(cache=True, boundscheck=False)
+def _update_counts(g, counts, unsat_blocks, bounds, R, x, y, color, delta):
+    '''
+    Add delta to the count of color in the neighborhood of every home
+    within distance R of (x, y), and keep the number of unsatisfied
+    homeowners in each block of a row up to date.
+
+    Inputs:
+        g (np.ndarray): the grid as color codes
+        counts (np.ndarray): (2, N, N) neighbor counts, updated in place
+        unsat_blocks (np.ndarray): (2, N, N / BLOCK) number of unsatisfied
+          homeowners of each color in each block, updated in place
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
+        R (int): neighborhood parameter
+        x, y (int): a grid location
+        color (int): color code of the home at (x, y)
+        delta (int): +1 when the home is taken, -1 when it is vacated
+    '''
+
+    N = g.shape[0]
+    c = color - 1
+    for i in range(max(0, x-R), min(N, x+R+1)):
+        w = R - abs(x-i)
+        for j in range(max(0, y-w), min(N, y+w+1)):
+            owner = g[i, j]
+            if owner == FOR_SALE:
+                counts[c, i, j] += delta
+                continue
+            was_satisfied = _satisfied(counts, bounds, i, j, owner)
+            counts[c, i, j] += delta
+            if was_satisfied != _satisfied(counts, bounds, i, j, owner):
+                if was_satisfied:
+                    unsat_blocks[owner-1, i, j // BLOCK] += 1
+                else:
+                    unsat_blocks[owner-1, i, j // BLOCK] -= 1
+
+
+@njit(cache=True, boundscheck=False)
+def _relocate(g, counts, unsat_blocks, bounds, R, x, y, a, b, color):
+    '''
+    Move the homeowner at (x, y) into the home for sale at (a, b).
+
+    Inputs:
+        g (np.ndarray): the grid as color codes, updated in place
+        counts (np.ndarray): neighbor counts for g, updated in place
+        unsat_blocks (np.ndarray): unsatisfied homeowners per block,
+          updated in place
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
+        R (int): neighborhood parameter
+        x, y (int): the homeowner's location
+        a, b (int): location of the home for sale
+        color (int): color code of the homeowner
+    '''
+
+    if not _satisfied(counts, bounds, x, y, color):
+        unsat_blocks[color-1, x, y // BLOCK] -= 1
+    g[x, y] = FOR_SALE
+    _update_counts(g, counts, unsat_blocks, bounds, R, x, y, color, -1)
+    _update_counts(g, counts, unsat_blocks, bounds, R, a, b, color, 1)
+    g[a, b] = color
+    if not _satisfied(counts, bounds, a, b, color):
+        unsat_blocks[color-1, a, b // BLOCK] += 1
+
 
-def find_new_home(grid, R, location, patience, sim_sat_range, homes_for_sale):
+def _count_unsatisfied(g, counts, bounds):
+    '''
+    Count the unsatisfied maroon and blue homeowners in each block of
+    BLOCK homes along a row.
+
+    Inputs:
+        g (np.ndarray): the grid as color codes
+        counts (np.ndarray): neighbor counts for g
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
+
+    Returns: (np.ndarray) (2, N, N / BLOCK) array where [color - 1, i, k]
+      is the number of unsatisfied homeowners of that color in row i,
+      columns k*BLOCK up to (k+1)*BLOCK
+    '''
+
+    S = np.where(g == BLUE, counts[1], counts[0])
+    H = counts[0] + counts[1]
+    satisfied = (bounds[H, 0] <= S) & (S <= bounds[H, 1])
+    unsatisfied = (g != FOR_SALE) & ~satisfied
+
+    N = len(g)
+    num_blocks = -(-N // BLOCK)
+    unsat_blocks = np.zeros((2, N, num_blocks), dtype=np.int32)
+    for c, color in enumerate((MAROON, BLUE)):
+        by_home = unsatisfied & (g == color)
+        for k in range(num_blocks):
+            block = by_home[:, k*BLOCK:(k+1)*BLOCK]
+            unsat_blocks[c, :, k] = block.sum(axis=1)
+
+    return unsat_blocks
+
+
+def _count_neighbors(g, R):
+    '''
+    Count the maroon and blue homes in the R-neighborhood of every home.
+
+    Inputs:
+        g (np.ndarray): the grid as color codes
+        R (int): neighborhood parameter
+
+    Returns: (np.ndarray) (2, N, N) array where [color - 1, i, j] is the
+      number of homes of that color in the neighborhood of (i, j)
+    '''
+
+    N = len(g)
+    # One plane per color, so that a move only touches the plane of the
+    # homeowner's color
+    counts = np.zeros((2, N, N), dtype=np.int32)
+
+    for c, color in enumerate((MAROON, BLUE)):
+        # prefix[i, R + j] is the number of homes of color in g[i, :j],
+        # padded on both sides so that out of range columns clip
+        prefix = np.zeros((N, N + 2*R + 1), dtype=np.int32)
+        np.cumsum(g == color, axis=1, dtype=np.int32,
+                  out=prefix[:, R+1:R+N+1])
+        prefix[:, R+N+1:] = prefix[:, R+N:R+N+1]
+
+        # Row x+di of the diamond around (x, y) covers the columns
+        # y-w..y+w with w = R-|di|; add that row slice for every (x, y)
+        # at once.
+        for di in range(-min(R, N-1), min(R, N-1) + 1):
+            w = R - abs(di)
+            window = prefix[:, R+w+1:R+w+1+N] - prefix[:, R-w:R-w+N]
+            if di >= 0:
+                counts[c, :N-di] += window[di:]
+            else:
+                counts[c, -di:] += window[:N+di]
+
+    return counts
+
+
+@njit(cache=True, boundscheck=False)
+def _satisfied_if_moved(counts, bounds, R, x, y, a, b, color):
+    '''
+    Determine whether the homeowner at (x, y) would be satisfied after
+    moving to the home for sale at (a, b), without changing the grid.
+
+    Inputs:
+        counts (np.ndarray): neighbor counts for the grid
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
+        R (int): neighborhood parameter
+        x, y (int): the homeowner's location
+        a, b (int): location of a home for sale
+        color (int): color code of the homeowner
+
+    Returns: bool
+    '''
+
+    # Moving adds the homeowner to the neighborhood of (a, b) and
+    # removes the home at (x, y) from it if it is close enough.
+    near = 1 if abs(x-a) + abs(y-b) <= R else 0
+    S = counts[color-1, a, b] + 1 - near
+    H = counts[0, a, b] + counts[1, a, b] + 1 - near
+
+    return bounds[H, 0] <= S <= bounds[H, 1]
+
+
+@njit(cache=True, boundscheck=False)
+def _take_home(homes, head, k, x, y):
+    '''
+    Remove the k-th home for sale and put the vacated home (x, y) at the
+    front of the homes for sale. Same as homes.insert(0, (x, y)) followed
+    by homes.remove(homes[k]) on a list.
+
+    Inputs:
+        homes (np.ndarray): (n, 2) circular buffer of homes for sale,
+          updated in place
+        head (np.ndarray): one-element array with the index in homes of
+          the first home for sale, updated in place
+        k (int): position of the home taken, counted from the front
+        x, y (int): location of the vacated home
+    '''
+
+    n = homes.shape[0]
+    h = head[0]
+
+    # Close the gap from whichever side needs fewer moves
+    if k < n - 1 - k:
+        for m in range(k, 0, -1):
+            dst = (h + m) % n
+            src = (h + m - 1) % n
+            homes[dst, 0] = homes[src, 0]
+            homes[dst, 1] = homes[src, 1]
+    else:
+        for m in range(k, n - 1):
+            dst = (h + m) % n
+            src = (h + m + 1) % n
+            homes[dst, 0] = homes[src, 0]
+            homes[dst, 1] = homes[src, 1]
+        h = (h + n - 1) % n
+        head[0] = h
+
+    homes[h, 0] = x
+    homes[h, 1] = y
+
+
+@njit(cache=True, boundscheck=False)
+def _find_new_home(g, counts, unsat_blocks, bounds, R, x, y, color, patience,
+                   homes, head):
     '''
     Find and relocate homeowner to new home by placing the homeowner in a
     home for sale and checking if he is satisfied. When patience hits zero, 
     homeowner is relocated to a home where he is satisfied and city layout changes.
 
     Inputs:
-        grid: the grid
+        g (np.ndarray): the grid as color codes
+        counts (np.ndarray): neighbor counts for g, updated in place
+        unsat_blocks (np.ndarray): unsatisfied homeowners per block,
+          updated in place
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
         R (int): neighborhood parameter
-        location (int, int): a grid location
+        x, y (int): the homeowner's location
+        color (int): color code of the homeowner
         patience (int): number of satisfactory homes that must be visited 
         before relocating
-        sim_sat_range (float, float): lower bound and upper bound on
-          the range (inclusive) for when the homeowner is satisfied
-          with his similarity score
-        homes_for_sale (list of tuples): list of locations of homes for sale
+        homes (np.ndarray): (n, 2) circular buffer of locations of homes
+          for sale, updated in place
+        head (np.ndarray): one-element array with the index in homes of
+          the first home for sale, updated in place
 
-    Returns: tuple with updated grid, number of relocations
+    Returns: (int) number of relocations
     '''
 
-    x,y = location
-    relocations = 0
-    
-    for home in homes_for_sale:
-
-        a,b = home
-        grid[x][y], grid[a][b] = grid[a][b], grid[x][y] 
-
-        if patience > 1:
-            if is_satisfied(grid, R, (a, b), sim_sat_range):  
-                patience -= 1     
-            grid[x][y], grid[a][b] = grid[a][b], grid[x][y]     
-
-        elif patience == 1:
-            if is_satisfied(grid, R, (a, b), sim_sat_range):
-                patience -= 1
-                homes_for_sale.insert(0,location)
-                homes_for_sale.remove(home)
-                relocations += 1
-                break
-            else:
-                grid[x][y], grid[a][b] = grid[a][b], grid[x][y]
-               
-    return (grid, relocations)
+    n = homes.shape[0]
+
+    for k in range(n):
+
+        p = (head[0] + k) % n
+        a = homes[p, 0]
+        b = homes[p, 1]
 
+        if _satisfied_if_moved(counts, bounds, R, x, y, a, b, color):
+            patience -= 1
+            if patience == 0:
+                _relocate(g, counts, unsat_blocks, bounds, R, x, y, a, b,
+                          color)
+                _take_home(homes, head, k, x, y)
+                return 1
 
-def simulate_wave(grid, R, patience, sim_sat_range, homes_for_sale, color):
+    return 0
+
+
+@njit(cache=True, boundscheck=False)
+def _simulate_wave(g, counts, unsat_blocks, bounds, R, patience, homes, head,
+                   color):
     '''
     Simulates one relocation wave for either maroon or blue homeowners
 
     Inputs:
-        grid: the grid
+        g (np.ndarray): the grid as color codes
+        counts (np.ndarray): neighbor counts for g, updated in place
+        unsat_blocks (np.ndarray): unsatisfied homeowners per block,
+          updated in place
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
         R (int): neighborhood parameter
         patience (int): number of satisfactory homes that must be visited 
            before relocating
-        sim_sat_range (float, float): lower bound and upper bound on
-          the range (inclusive) for when the homeowner is satisfied
-          with his similarity score
-        homes_for_sale (list of tuples): list of locations with homes for sale
-        color: color of relocation wave
+        homes (np.ndarray): (n, 2) circular buffer of locations with homes
+          for sale
+        head (np.ndarray): one-element array with the index in homes of
+          the first home for sale
+        color (int): color code of relocation wave
 
-    Returns: tuple with updated grid, number of relocations during one wave
+    Returns: (int) number of relocations during one wave
     '''
 
     counter = 0
-    for i, row in enumerate(grid):
-        for j, val in enumerate(row):
-            if val == color:
-                if not is_satisfied(grid, R, (i,j), sim_sat_range):
-                    grid, relocations = find_new_home(grid, R, (i,j), patience, 
-                    sim_sat_range, homes_for_sale)
-                    counter += relocations
+    N = g.shape[0]
+    c = color - 1
+    for i in range(N):
+        for k in range(unsat_blocks.shape[2]):
+            # Homeowners only become unsatisfied when someone moves, and
+            # only unsatisfied homeowners move, so blocks without any are
+            # skipped without reading the grid.
+            if unsat_blocks[c, i, k] == 0:
+                continue
+            for j in range(k*BLOCK, min(N, (k+1)*BLOCK)):
+                if g[i, j] == color:
+                    if not _satisfied(counts, bounds, i, j, color):
+                        counter += _find_new_home(g, counts, unsat_blocks,
+                                                  bounds, R, i, j, color,
+                                                  patience, homes, head)
+                        if unsat_blocks[c, i, k] == 0:
+                            break
+
+    return counter
+
+
+@njit(cache=True, boundscheck=False)
+def _simulate_step(g, counts, unsat_blocks, bounds, R, patience, homes, head,
+                   blue_idle):
+    '''
+    Compiled step for simulate_step: the maroon wave and then the blue
+    wave, in a single call.
+
+    Returns: tuple with number of relocations during one step and whether
+      the blue wave had no relocations
+    '''
 
-    return (grid, counter)
+    # The blue wave has to see the moves made by the maroon wave, so the
+    # waves stay two ordered passes over the grid.
+    maroon_relocations = _simulate_wave(g, counts, unsat_blocks, bounds, R,
+                                        patience, homes, head, MAROON)
+    if maroon_relocations == 0 and blue_idle:
+        # Nothing has changed since the last blue wave, which moved no
+        # one, so this blue wave would not move anyone either.
+        return (0, True)
 
+    blue_relocations = _simulate_wave(g, counts, unsat_blocks, bounds, R,
+                                      patience, homes, head, BLUE)
 
-def simulate_step(grid, R, patience, sim_sat_range, homes_for_sale):
+    return (maroon_relocations + blue_relocations, blue_relocations == 0)
+
+
+def simulate_step(g, counts, unsat_blocks, bounds, R, patience, homes, head,
+                  blue_idle=False):
     '''
     Simulates one step of the simulation, where there's a maroon wave followed by a blue wave
 
     Inputs:
-        grid: the grid
+        g (np.ndarray): the grid as color codes
+        counts (np.ndarray): neighbor counts for g (see _count_neighbors)
+        unsat_blocks (np.ndarray): unsatisfied homeowners per block of a
+          row (see _count_unsatisfied)
+        bounds (np.ndarray): satisfactory ranges (see _satisfaction_bounds)
         R (int): neighborhood parameter
         patience (int): number of satisfactory homes that must be visited 
           before relocating
-        sim_sat_range (float, float): lower bound and upper bound on
-          the range (inclusive) for when the homeowner is satisfied
-          with his similarity score
-        homes_for_sale (list of tuples): a list of locations with homes for sale
-
-    Returns: tuple with updated grid, number of relocations during one step
+        homes (np.ndarray): (n, 2) circular buffer of locations with homes
+          for sale
+        head (np.ndarray): one-element array with the index in homes of
+          the first home for sale
+        blue_idle (bool): True if the previous step's blue wave had no
+          relocations
+
+    Returns: tuple with updated grid, number of relocations during one
+      step, and whether this step's blue wave had no relocations
     '''
 
-    grid_after_m, maroon_relocations = simulate_wave(grid, R, patience, sim_sat_range, homes_for_sale, "M")  
-    updated_grid, blue_relocations = simulate_wave(grid_after_m, R, patience, sim_sat_range, homes_for_sale, "B")
-    relocations = maroon_relocations + blue_relocations
+    relocations, blue_idle = _simulate_step(g, counts, unsat_blocks, bounds,
+                                            R, patience, homes, head,
+                                            blue_idle)
 
-    return (updated_grid, relocations)
+    return (g, relocations, blue_idle)
 
 def do_simulation(grid, R, sim_sat_range, patience, max_steps, homes_for_sale):
     '''
     Do a full simulation.
 
     Inputs:
-        grid (list of lists of strings): the grid
+        grid: the grid (list of lists of strings or np.ndarray of color
+          codes), updated in place
         R (int): neighborhood parameter
         sim_sat_range (float, float): lower bound and upper bound on
           the range (inclusive) for when the homeowner is satisfied
@@ -188,14 +603,29 @@ def do_simulation(grid, R, sim_sat_range, patience, max_steps, homes_for_sale):
     Returns: (int) The number of relocations completed.
     '''
 
+    g = to_array(grid)
+    homes = np.array(homes_for_sale, dtype=np.int32).reshape(-1, 2)
+    head = np.zeros(1, dtype=np.int64)
+    counts = _count_neighbors(g, R)
+    bounds = _satisfaction_bounds(R, len(g), sim_sat_range)
+    unsat_blocks = _count_unsatisfied(g, counts, bounds)
     total_relocations = 0
+    blue_idle = False
 
     for i in range(0, max_steps):
-        grid, relocations = simulate_step(grid, R, patience, sim_sat_range, homes_for_sale)
+        g, relocations, blue_idle = simulate_step(g, counts, unsat_blocks,
+                                                  bounds, R, patience, homes,
+                                                  head, blue_idle)
         if relocations == 0: 
             break 
         total_relocations += relocations
 
+    # An array grid is g itself and was updated in place
+    if not isinstance(grid, np.ndarray):
+        copy_to_grid(g, grid)
+    homes = np.roll(homes, -head[0], axis=0)
+    homes_for_sale[:] = [tuple(home) for home in homes.tolist()]
+
     return total_relocations
 
 
@@ -0,0 +1,158 @@
+"""
+CS121: Schelling Model of Housing Segregation
+
+Test code that checks do_simulation against a plain scan of the grid
+on random cities
+"""
+
+import os
+import sys
+import random
+import pytest
+
+# Handle the fact that the grading code may not
+# be in the same directory as schelling.py
+sys.path.insert(0, os.getcwd())
+
+# Keep pylint from complaining about generated code.
+#pylint: disable-msg=wrong-import-position
+#pylint: disable-msg=missing-docstring
+
+import schelling
+
+
+def reference_is_satisfied(grid, R, location, sim_sat_range):
+    '''
+    Compute the similarity score of the homeowner at location by visiting
+    every home within distance R, and check it against the range.
+    '''
+
+    x, y = location
+    lb, ub = sim_sat_range
+    S = 0
+    H = 0
+
+    for i in range(x-R, x+R+1):
+        for j in range(y-R, y+R+1):
+            if 0 <= i < len(grid) and 0 <= j < len(grid):
+                if abs(x-i) + abs(y-j) <= R:
+                    if grid[i][j] == grid[x][y]:
+                        S += 1
+                        H += 1
+                    elif grid[i][j] != "F":
+                        H += 1
+
+    return lb <= S/H <= ub
+
+
+def reference_do_simulation(grid, R, sim_sat_range, patience, max_steps,
+                            homes_for_sale):
+    '''
+    Do a full simulation the slow way: rescan every neighborhood, try each
+    home for sale by moving the homeowner there and back, and keep the homes
+    for sale in a list. Same inputs and result as schelling.do_simulation.
+    '''
+
+    total_relocations = 0
+
+    for _ in range(max_steps):
+        relocations = 0
+        for color in "MB":
+            for i, row in enumerate(grid):
+                for j in range(len(row)):
+                    if row[j] != color:
+                        continue
+                    if reference_is_satisfied(grid, R, (i, j), sim_sat_range):
+                        continue
+                    remaining = patience
+                    for home in homes_for_sale:
+                        a, b = home
+                        grid[i][j], grid[a][b] = "F", color
+                        if reference_is_satisfied(grid, R, home,
+                                                  sim_sat_range):
+                            remaining -= 1
+                            if remaining == 0:
+                                homes_for_sale.insert(0, (i, j))
+                                homes_for_sale.remove(home)
+                                relocations += 1
+                                break
+                        grid[i][j], grid[a][b] = color, "F"
+        if relocations == 0:
+            break
+        total_relocations += relocations
+
+    return total_relocations
+
+
+def random_city(rng, N, for_sale):
+    '''
+    Make an N x N grid where each home is for sale with probability
+    for_sale, and otherwise maroon or blue with equal odds.
+    '''
+
+    grid = [[("F" if rng.random() < for_sale else rng.choice("MB"))
+             for _ in range(N)] for _ in range(N)]
+    homes_for_sale = [(i, j) for i in range(N) for j in range(N)
+                      if grid[i][j] == "F"]
+    rng.shuffle(homes_for_sale)
+
+    return grid, homes_for_sale
+
+
+def compare_simulations(seed, N, for_sale, R, sim_sat_range, patience,
+                        max_steps):
+    grid, homes_for_sale = random_city(random.Random(seed), N, for_sale)
+
+    expected_grid = [row[:] for row in grid]
+    expected_homes = homes_for_sale[:]
+    expected = reference_do_simulation(expected_grid, R, sim_sat_range,
+                                       patience, max_steps, expected_homes)
+    actual = schelling.do_simulation(grid, R, sim_sat_range, patience,
+                                     max_steps, homes_for_sale)
+
+    recreate_msg = ("random city from seed {}, N={}, for_sale={}: "
+                    "R={}, sim_sat_range={}, patience={}, max_steps={}")
+    recreate_msg = recreate_msg.format(seed, N, for_sale, R, sim_sat_range,
+                                       patience, max_steps)
+
+    assert actual == expected, recreate_msg
+    assert grid == expected_grid, recreate_msg
+    assert homes_for_sale == expected_homes, recreate_msg
+
+
+@pytest.mark.parametrize("seed", range(150))
+def test_do_simulation_random_small(seed):
+    rng = random.Random(-seed)
+    N = rng.randint(1, 12)
+    R = rng.randint(0, 3)
+    lb = rng.choice([0.0, 0.25, 0.4, 0.5, 1/3, rng.random()])
+    ub = rng.choice([lb, 0.7, 2/3, 1.0, lb + (1 - lb)*rng.random()])
+    patience = rng.randint(1, 4)
+    compare_simulations(seed, N, 0.25, R, (lb, ub), patience, 8)
+
+
+# Grids wider than one 64-home block of a row, to cover the blocks that
+# do_simulation skips when they have no unsatisfied homeowners.
+@pytest.mark.parametrize("seed,N", [(0, 63), (1, 64), (2, 65), (3, 70),
+                                    (4, 129)])
+def test_do_simulation_random_wide(seed, N):
+    compare_simulations(seed, N, 0.01, 1, (0.4, 0.7), 2, 2)
+
+
+# S/H and S compared with a bound times H round differently at some H up
+# to 85 for a lower bound of 0.14, 0.28, 0.56 or 0.68 and an upper bound
+# of 0.58.
+@pytest.mark.parametrize("sim_sat_range", [(0.4, 0.7), (1/3, 2/3),
+                                           (0.5, 0.5), (0.0, 1.0),
+                                           (0.28, 0.56), (0.14, 0.68),
+                                           (0.14, 0.58), (0.29, 0.87)])
+def test_satisfaction_bounds(sim_sat_range):
+    lb, ub = sim_sat_range
+    R = 6
+    bounds = schelling._satisfaction_bounds(R, 100, sim_sat_range)
+
+    for H in range(1, 2*R*(R+1) + 2):
+        for S in range(H + 1):
+            expected = lb <= S/H <= ub
+            actual = bounds[H, 0] <= S <= bounds[H, 1]
+            assert actual == expected, "S={}, H={}".format(S, H)
@@ -6,15 +6,48 @@ Evelyn Dang, Corry Ke
 Main file for polling place simulation
 '''
 
+import functools
+import os
 import sys
 import random
-import queue
+from concurrent.futures import ProcessPoolExecutor
 import click
+import numpy as np
 import util
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(**_options):
+        '''
+        Stand-in for numba.njit when numba is not installed: the kernels
+        below run as plain Python, just more slowly.
+        '''
+        return lambda func: func
+
+# Fewest simulated voters (trials times voters per trial) for which
+# find_avg_wait_time farms the trials out to worker processes; below this
+# starting the pool costs more than it saves.
+PARALLEL_MIN_VOTERS = 200000
+
+# Precinct dictionary entries that determine find_avg_wait_time's result
+PRECINCT_FIELDS = ("name", "hours_open", "num_voters", "num_booths",
+                   "arrival_rate", "voting_duration_rate",
+                   "straight_ticket_duration")
+
+# Percentages of split-ticket voters tried by find_percent_split_ticket
+SPLIT_GRID = tuple(round(i * 0.1, 1) for i in range(11))
+
+# Most booths for which the booth loop finds the earliest departure by
+# scanning every booth instead of keeping a heap
+SCAN_MAX_BOOTHS = 16
+
 
 
 class Voter:
+    __slots__ = ("arrival_time", "voting_duration", "start_time",
+                 "departure_time")
+
     def __init__(self, arrival_time, voting_duration):
         '''
         Constructor for the Voter class
@@ -51,31 +84,53 @@ class Precinct(object):
         self.arrival_rate = arrival_rate
         self.voting_duration_rate = voting_duration_rate
 
-    def next_voter(self, time, percent_straight_ticket):
+    def gen_voters(self, minutes_open, percent_straight_ticket,
+                   straight_ticket_duration, rng):
         '''
-        Returns the next voter in a precinct, with the start time 
-            and departure time set as None
+        Draws the arrival times and voting durations of the voters who
+            arrive before the polls close, all in one pass
 
         Inputs:
-        time: (float) the time where the current voter has finished
+        minutes_open: (int) minutes the precinct remains open
         percent_straight_ticket: (float) percentage of voters voting a straight ticket
+        straight_ticket_duration: (float) voting duration for straight-ticket voters
+        rng: (random.Random) the random number generator to draw from
 
-        Output: 
-        Voter class object, the next voter in the precinct 
+        Output:
+        (arrivals, durations) as a pair of lists of floats
         '''
 
-        gap, voting_duration = util.gen_voter_parameters(self.arrival_rate, 
-                                                        self.voting_duration_rate, 
-                                                        percent_straight_ticket, 
-                                                        straight_ticket_duration=2)
-        next_voter = Voter(time + gap, voting_duration)
+        rand = rng.random
+        expovariate = rng.expovariate
+        voting_duration_rate = self.voting_duration_rate
+        arrival_rate = self.arrival_rate
+        arrivals = []
+        durations = []
 
-        return next_voter
+        t = 0
 
+        for i in range(self.max_num_voters):
+            # same draws, in the same order, as util.gen_voter_parameters
+            if rand() <= percent_straight_ticket:
+                voting_duration = straight_ticket_duration
+            else:
+                voting_duration = expovariate(voting_duration_rate)
+            t += expovariate(arrival_rate)
 
-    def simulate(self, percent_straight_ticket, straight_ticket_duration, seed):
+            if t >= minutes_open:
+                break
+
+            arrivals.append(t)
+            durations.append(voting_duration)
+
+        return arrivals, durations
+
+
+    def run_day(self, percent_straight_ticket, straight_ticket_duration,
+                seed, out=None):
         '''
-        Simulate a day of voting
+        Simulate a day of voting, shared by simulate_times and
+            simulate_total_wait
 
         Input:
             percent_straight_ticket: (float) Percentage of straight-ticket
@@ -83,113 +138,320 @@ class Precinct(object):
             straight_ticket_duration: (float) Voting duration for
               straight-ticket voters
             seed: (int) Random seed to use in the simulation
+            out: (tuple) Optional three float arrays with room for
+              max_num_voters entries, reused across calls to hold the
+              results instead of allocating new arrays
 
         Output:
-            List of voters who voted in the precinct
+            (arrival_times, voting_durations, start_times, total_wait):
+              float arrays with one entry per voter who voted, in order
+              of arrival, and the total time those voters spent waiting
         '''
 
-        random.seed(seed)
-        voters = []
-        booths = VotingBooths(self.num_booths)
+        # A generator of its own leaves the global random state alone,
+        # so trials cannot disturb each other; seeded the same way, it
+        # gives the same draws as random.seed(seed).
+        rng = random.Random(seed)
         minutes_open = self.hours_open * 60
 
-        t = 0
+        arrivals, durations = self.gen_voters(minutes_open,
+                                              percent_straight_ticket,
+                                              straight_ticket_duration, rng)
+        n = len(arrivals)
+        if out is None:
+            out = (np.empty(n), np.empty(n), np.empty(n))
+        arrival_times, voting_durations, start_times = (a[:n] for a in out)
+        arrival_times[:] = arrivals
+        voting_durations[:] = durations
+        total_wait = _run_booths(arrival_times, voting_durations,
+                                 self.num_booths, start_times)
 
-        for i in range(self.max_num_voters):
+        return arrival_times, voting_durations, start_times, total_wait
 
-            gap, voting_duration = util.gen_voter_parameters(self.arrival_rate, 
-                                            self.voting_duration_rate, percent_straight_ticket, straight_ticket_duration=2)   
-            
-            next_arrival = t + gap
-            t = next_arrival
 
-            if t >= minutes_open:
-                break
-           
-            elif t == next_arrival:
-                voter = Voter(t, voting_duration)
-                if not booths.is_full(): 
-                    booths.add_voter(voter, t, voting_duration)
-                else: 
-                    latest_departure = booths.remove_voter()
-                    if latest_departure > t:
-                        booths.add_voter(voter, latest_departure, voting_duration)
-                    else:
-                        booths.add_voter(voter, t, voting_duration)
-                voters.append(voter)
-         
-        return voters
+    def simulate_times(self, percent_straight_ticket, straight_ticket_duration,
+                       seed, out=None):
+        '''
+        Simulate a day of voting, keeping the voters as arrays of times
+            rather than Voter objects
 
+        Input:
+            percent_straight_ticket, straight_ticket_duration, seed, out:
+              as for run_day
+
+        Output:
+            (arrival_times, voting_durations, start_times) as float arrays,
+              one entry per voter who voted, in order of arrival
+        '''
+
+        arrival_times, voting_durations, start_times, _ = self.run_day(
+            percent_straight_ticket, straight_ticket_duration, seed, out)
+
+        return arrival_times, voting_durations, start_times
 
-class VotingBooths(object):
-    '''
-    Voting booths in a precinct
-    '''
 
-    def __init__(self, num_booths):
+    def simulate_total_wait(self, percent_straight_ticket,
+                            straight_ticket_duration, seed, out=None):
         '''
-        Constructor
+        Simulate a day of voting, keeping only how long the voters waited
 
         Input:
-            num_booths: (int) the number of booths in a precinct
+            percent_straight_ticket, straight_ticket_duration, seed, out:
+              as for run_day
+
+        Output:
+            (total_wait, num_voted): the total time voters spent waiting
+              and the number of voters who voted
         '''
 
-        self.__pq = queue.PriorityQueue(maxsize = num_booths)
+        arrival_times, _, _, total_wait = self.run_day(
+            percent_straight_ticket, straight_ticket_duration, seed, out)
 
+        return total_wait, arrival_times.shape[0]
 
-    def add_voter(self, voter, start_time, voting_duration):
+
+    def simulate(self, percent_straight_ticket, straight_ticket_duration, seed):
         '''
-        Adds a voter to the booth
-        
+        Simulate a day of voting
+
         Input:
-            voter: (Voter) the new voter
-            start_time: (float) time our new voter started voting
-            voting_duration: (float) time it took the new voter to vote
-        
-        Output: None
+            percent_straight_ticket: (float) Percentage of straight-ticket
+              voters as a decimal between 0 and 1 (inclusive)
+            straight_ticket_duration: (float) Voting duration for
+              straight-ticket voters
+            seed: (int) Random seed to use in the simulation
+
+        Output:
+            List of voters who voted in the precinct
         '''
 
-        voter.start_time = start_time
-        voter.departure_time = start_time + voting_duration
-        self.__pq.put(voter.departure_time, block = False) 
-    
+        arrival_times, voting_durations, start_times = self.simulate_times(
+            percent_straight_ticket, straight_ticket_duration, seed)
 
-    def remove_voter(self):
-        '''
-        Removes a voter from the voting booth
-        
-        Input: None
-        
-        Output: (float) time of departure
-        '''
+        voters = []
+        for t, voting_duration, start_time in zip(arrival_times.tolist(),
+                                                  voting_durations.tolist(),
+                                                  start_times.tolist()):
+            voter = Voter(t, voting_duration)
+            voter.start_time = start_time
+            voter.departure_time = start_time + voting_duration
+            voters.append(voter)
+         
+        return voters
 
-        departure_time = self.__pq.get(block = False)
 
-        return departure_time
-    
+@njit(cache=True)
+def _heap_push(heap, n, value):
+    '''
+    Pushes a value onto a min-heap stored in the first n slots of an array
 
-    def is_empty(self):
-        '''
-        Check if voting booths are empty
-        
-        Input: None
+    Input:
+        heap: (np.ndarray) the heap, with room for at least n + 1 values
+        n: (int) number of values in the heap
+        value: (float) the value to push
 
-        Output: (bool)
-        '''
-        
-        return self.__pq.empty()
+    Output: None
+    '''
 
+    i = n
+    while i > 0:
+        parent = (i - 1) // 2
+        if heap[parent] <= value:
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = value
 
-    def is_full(self):
-        '''
-        Check if voting booths are full
 
-        Input: None
+@njit(cache=True)
+def _heap_replace(heap, n, value):
+    '''
+    Replaces the smallest value of a min-heap stored in the first n slots
+        of an array with a new value, in a single sift down: the same as
+        a pop followed by a push, at half the work
 
-        Output: (bool)
-        '''
+    Input:
+        heap: (np.ndarray) the heap
+        n: (int) number of values in the heap, at least one
+        value: (float) the value to push
+
+    Output: None
+    '''
+
+    i = 0
+    while True:
+        child = 2*i + 1
+        if child >= n:
+            break
+        if child + 1 < n and heap[child + 1] < heap[child]:
+            child += 1
+        if value <= heap[child]:
+            break
+        heap[i] = heap[child]
+        i = child
+    heap[i] = value
+
+
+@njit(cache=True)
+def _scan_booths(arrivals, durations, num_booths, start_times):
+    '''
+    Booth loop for a handful of booths, keeping one free time per booth
+        and scanning them all for the earliest: a small array beats the
+        upkeep of a heap
+
+    Input:
+        arrivals: (np.ndarray) arrival times, in order
+        durations: (np.ndarray) voting durations
+        num_booths: (int) the number of booths in the precinct
+        start_times: (np.ndarray) filled with the time each voter starts
+          voting
+
+    Output: (float) the total time voters spent waiting
+    '''
+
+    # Time each booth frees up, 0 for a booth nobody has used yet. A booth
+    # freed before a voter arrives is as good as unused, as arrivals only
+    # increase, so this starts voters exactly when the heap would.
+    booths = np.zeros(num_booths)
+    total_wait = 0.0
+
+    for i in range(arrivals.shape[0]):
+        t = arrivals[i]
+        k = 0
+        for b in range(1, num_booths):
+            if booths[b] < booths[k]:
+                k = b
+        if booths[k] > t:
+            start_time = booths[k]
+        else:
+            start_time = t
+        start_times[i] = start_time
+        total_wait += start_time - t
+        booths[k] = start_time + durations[i]
+
+    return total_wait
+
+
+@njit(cache=True)
+def _run_booths(arrivals, durations, num_booths, start_times):
+    '''
+    Compiled booth loop for Precinct.simulate: voters take a free booth
+        as soon as they arrive, or else wait for the earliest departure
+
+    Input:
+        arrivals: (np.ndarray) arrival times, in order
+        durations: (np.ndarray) voting durations
+        num_booths: (int) the number of booths in the precinct; fewer
+          than one means no limit, as with the unbounded queue the
+          booths used to be
+        start_times: (np.ndarray) filled with the time each voter starts
+          voting
+
+    Output: (float) the total time voters spent waiting
+    '''
+
+    if num_booths < 1:
+        start_times[:] = arrivals
+        return 0.0
+
+    if num_booths <= SCAN_MAX_BOOTHS:
+        return _scan_booths(arrivals, durations, num_booths, start_times)
 
-        return self.__pq.full()
+    # departure times of the voters in the booths
+    booths = np.empty(num_booths)
+    total_wait = 0.0
+    n = 0
+
+    for i in range(arrivals.shape[0]):
+        t = arrivals[i]
+        if n < num_booths:
+            start_time = t
+            _heap_push(booths, n, start_time + durations[i])
+            n += 1
+        else:
+            # The new departure is never before the one it replaces, so
+            # work out the start from the earliest departure first and
+            # swap it for the new one in one sift down.
+            latest_departure = booths[0]
+            if latest_departure > t:
+                start_time = latest_departure
+            else:
+                start_time = t
+            _heap_replace(booths, n, start_time + durations[i])
+        start_times[i] = start_time
+        total_wait += start_time - t
+
+    return total_wait
+
+
+def _run_trials(args):
+    '''
+    Simulates a precinct once per seed and computes the average waiting
+    time of its voters in each trial. Kept at module level so worker
+    processes can run it.
+
+    Input:
+        args: (tuple) The precinct's fields (see PRECINCT_FIELDS), the
+          percentage of straight-ticket voters and the seeds of the trials
+
+    Output:
+        (list of floats) The average waiting time of each trial
+    '''
+
+    fields, percent_straight_ticket, seeds = args
+    (name, hours_open, max_num_voters, num_booths, arrival_rate,
+     voting_duration_rate, straight_duration) = fields
+    p = Precinct(name, hours_open, max_num_voters, num_booths, arrival_rate,
+                 voting_duration_rate)
+    # shared by all of the trials
+    out = (np.empty(max_num_voters), np.empty(max_num_voters),
+           np.empty(max_num_voters))
+
+    avg_times = []
+    for seed in seeds:
+        total_wait, _ = p.simulate_total_wait(percent_straight_ticket,
+                                              straight_duration, seed, out)
+        avg_times.append(total_wait / max_num_voters)
+
+    return avg_times
+
+
+@functools.lru_cache(maxsize=1024)
+def _median_wait_time(fields, percent_straight_ticket, ntrials, initial_seed):
+    '''
+    Does the work of find_avg_wait_time, cached: repeated queries for
+    the same precinct and parameters skip rerunning the trials.
+
+    Input:
+        fields: (tuple) The precinct's fields (see PRECINCT_FIELDS)
+        percent_straight_ticket: (float) Percentage straight-ticket voters
+        ntrials: (int) The number of trials to run
+        initial_seed: (int) Initial seed for random number generator
+
+    Output:
+        (float) The median of the average waiting times
+    '''
+
+    seeds = range(initial_seed, initial_seed + ntrials)
+    # no more workers than trials, so none starts with an empty batch
+    workers = min(os.cpu_count() or 1, ntrials)
+    max_num_voters = fields[PRECINCT_FIELDS.index('num_voters')]
+
+    if workers > 1 and ntrials * max_num_voters >= PARALLEL_MIN_VOTERS:
+        # one batch of seeds per worker
+        args = [(fields, percent_straight_ticket, seeds[w::workers])
+                for w in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            avg_times = [avg for batch in executor.map(_run_trials, args)
+                         for avg in batch]
+    else:
+        avg_times = _run_trials((fields, percent_straight_ticket, seeds))
+    
+    # the (ntrials // 2)-th smallest average, as indexing the sorted list
+    # would give (the upper of the two middle values for even ntrials)
+    k = ntrials // 2
+        
+    return float(np.partition(np.asarray(avg_times), k)[k])
 
 
 def find_avg_wait_time(precinct, percent_straight_ticket, ntrials, initial_seed = 0):
@@ -210,31 +472,10 @@ def find_avg_wait_time(precinct, percent_straight_ticket, ntrials, initial_seed
         the precinct 'ntrials' times.
     '''
 
-    name = precinct['name']
-    hours_open = precinct['hours_open']
-    max_num_voters = precinct['num_voters']
-    arrival_rate = precinct['arrival_rate']
-    num_booths = precinct['num_booths']
-    voting_duration = precinct['voting_duration_rate']
-    straight_duration = precinct['straight_ticket_duration']
-    p = Precinct(name, hours_open, max_num_voters, 
-                num_booths, arrival_rate, voting_duration)
-
-    seed = initial_seed
-    avg_times = []
+    fields = tuple(precinct[field] for field in PRECINCT_FIELDS)
 
-    for i in range(ntrials):
-        sim = p.simulate(percent_straight_ticket, straight_duration, seed)
-        total_wait = 0
-        for voter in sim:
-            total_wait += voter.start_time - voter.arrival_time
-        avg_wait = total_wait / max_num_voters
-        avg_times.append(avg_wait)
-        seed += 1
-    
-    sorted_times = sorted(avg_times)
-        
-    return sorted_times[ntrials // 2]
+    return _median_wait_time(fields, percent_straight_ticket, ntrials,
+                             initial_seed)
 
 
 def find_percent_split_ticket(precinct, target_wait_time, ntrials, seed=0):
@@ -257,19 +498,16 @@ def find_percent_split_ticket(precinct, target_wait_time, ntrials, seed=0):
         - waiting_time: (float) The actual average waiting time with that
                         percentage of split-ticket voters
 
-        If the target waiting time is infeasible, returns (0, None)
+        If the target waiting time is infeasible, returns (1.0, None)
     '''
 
-    lst = list(range(11))
-    percent_split_ticket = [round(i * 0.1, 1) for i in lst]
-
-    for percent in percent_split_ticket:
-        percent_split = percent
-        avg_wait_time = find_avg_wait_time(precinct, 1 - percent, ntrials, seed)
+    for percent_split in SPLIT_GRID:
+        avg_wait_time = find_avg_wait_time(precinct, 1 - percent_split, ntrials, seed)
         if avg_wait_time > target_wait_time:
             break
-        elif percent == 1 and avg_wait_time < target_wait_time:
-            avg_wait_time = None
+    else:
+        # no percentage of split-ticket voters gets above the target
+        return (1.0, None)
          
     return (percent_split, avg_wait_time)
 
@@ -316,7 +554,7 @@ def cmd(precincts_file, target_wait_time, print_voters):
                     pl = "s" if len(pvoters) > 1 else ""
                     closing = p["hours_open"]*60.
                     last_depart = pvoters[-1].departure_time
-                    avg_wt = sum([v.start_time - v.arrival_time for v in pvoters]) / len(pvoters)
+                    avg_wt = sum(v.start_time - v.arrival_time for v in pvoters) / len(pvoters)
                     print("PRECINCT '{}'".format(pname))
                     print("- {} voter{} voted.".format(len(pvoters), pl))
                     msg = "- Polls closed at {} and last voter departed at {:.2f}."
@@ -328,7 +566,7 @@ def cmd(precincts_file, target_wait_time, print_voters):
 
         percent, avg_wt = find_percent_split_ticket(precinct, target_wait_time, 20, seed)
 
-        if percent == 0:
+        if avg_wt is None:
             msg = "Waiting times are always below {:.2f}"
             msg += " in precinct '{}'"
             print(msg.format(target_wait_time, precinct["name"]))